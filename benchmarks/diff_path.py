@@ -0,0 +1,108 @@
+""" Memory and latency of the update_existing diff path: ORM entities vs column-only records
+
+Runs against an in-memory SQLite by default, pass --db to use a scratch PostgreSQL instead.
+Tables are created in that database and filled with generated posts.
+Importing forward.model still builds the configured engine with pool settings, which SQLite rejects,
+so db_uri in settings.json must be a PostgreSQL one (it is not connected to).
+
+    python benchmarks/diff_path.py --window 2000 --rounds 20
+"""
+import argparse
+import gc
+import random
+import time
+import tracemalloc
+
+from sqlalchemy import create_engine
+
+from forward.model import Profile, WallPost, db
+
+PROFILE_ID = 1
+
+
+def make_item(wall_post_id, likes=0, comments=0, text=None):
+    return {
+        'id': wall_post_id,
+        'from_id': PROFILE_ID,
+        'text': text or f'post {wall_post_id} ' * 20,
+        'likes': {'count': likes},
+        'comments': {'count': comments},
+        'attachments': [{'type': 'photo', 'photo': {'sizes': [{'height': 100, 'url': 'https://example.com/1.jpg'}]}}],
+    }
+
+
+def seed(engine, window):
+    db.create_all(bind=engine, tables=[Profile.__table__, WallPost.__table__])
+    db.add(Profile(profile_id=PROFILE_ID, first_name='first', last_name='last', data={}))
+    db.commit()
+    db.execute(WallPost.__table__.insert(), [WallPost.row_from_item(make_item(i)) for i in range(1, window + 1)])
+    db.commit()
+
+
+def mutate(items, changed_share):
+    """ VK window where a share of posts got new likes, as a typical tick """
+    for item in random.sample(items, int(len(items) * changed_share)):
+        item['likes']['count'] += 1
+    return {item['id']: item for item in items}
+
+
+def orm_path(to_update):
+    changed = []
+    for post in WallPost.get_existing_to_update(list(to_update)).all():
+        if post.update_existing(to_update[post.wall_post_id]):
+            changed.append(post.wall_post_id)
+    db.commit()
+    return changed
+
+
+def record_path(to_update):
+    changed = []
+    changed_items = []
+    for record in WallPost.get_records(list(to_update)):
+        item = to_update[record.wall_post_id]
+        if record.diff(item):
+            changed_items.append(item)
+            changed.append(record.wall_post_id)
+    WallPost.bulk_update(changed_items)
+    db.commit()
+    return changed
+
+
+def measure(path, items, rounds, changed_share):
+    timings = []
+    peaks = []
+    for _ in range(rounds):
+        to_update = mutate(items, changed_share)
+        gc.collect()
+        tracemalloc.start()
+        start = time.perf_counter()
+        path(to_update)
+        timings.append(time.perf_counter() - start)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        db._session.remove()
+    timings.sort()
+    return timings[len(timings) // 2], max(peaks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db', default='sqlite://', help='scratch database, its tables are created and filled')
+    parser.add_argument('--window', type=int, default=2000, help='posts per tick, e.g. 20 posts * 100 groups')
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--changed', type=float, default=0.1, help='share of posts changed per tick')
+    args = parser.parse_args()
+
+    engine = create_engine(args.db)
+    db.reconfigure(bind=engine)
+    seed(engine, args.window)
+    items = [make_item(i) for i in range(1, args.window + 1)]
+
+    print(f'window={args.window} rounds={args.rounds} changed={args.changed:.0%}')
+    for name, path in (('orm', orm_path), ('records', record_path)):
+        median, peak = measure(path, items, args.rounds, args.changed)
+        print(f'{name:>8}: median {median * 1000:8.2f} ms, peak memory {peak / 1024:10.1f} KiB')
+
+
+if __name__ == '__main__':
+    main()
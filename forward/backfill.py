@@ -0,0 +1,182 @@
+import argparse
+import asyncio
+import json
+import os
+from pathlib import Path
+
+import aiohttp
+from loguru import logger
+
+from forward import conf
+from forward.bot import ForwardBot
+from forward.forward import API, init_logging, send_post
+from forward.model import Profile, WallPost, db
+from forward.model.helpers import ThreadSwitcherWithDB, db_in_thread
+from forward.profiling import span
+from forward.throttle import RateLimiter
+
+# wall.get maximum
+PAGE_SIZE = 100
+# VK allows a user token 3 requests per second
+PAGE_RATE = 3
+# Unknown error, too many requests per second, flood control, internal server error
+TEMPORARY_ERRORS = {1, 6, 9, 10}
+MAX_RETRIES = 8
+
+
+class Checkpoint:
+    """ Offset of the first not imported post, counted from the top of the wall
+    """
+
+    def __init__(self):
+        self.path = Path(conf.root_dir) / f'backfill{conf.group_id}.json'
+
+    def load(self, total):
+        if not self.path.exists():
+            return 0
+        with open(self.path) as f:
+            state = json.load(f)
+        # New posts shift older ones down the wall, deleted posts shift them up
+        return max(0, state['offset'] + total - state['total'])
+
+    def save(self, offset, total):
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({'offset': offset, 'total': total}, f)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        if self.path.exists():
+            self.path.unlink()
+
+
+async def get_page(session, limiter, offset):
+    """ Paced by `limiter`, temporary VK and transport errors are retried with exponential backoff
+    """
+    params = {
+        'access_token': conf.access_token,
+        'v': conf.api_version,
+        'count': PAGE_SIZE,
+        'offset': offset,
+        'owner_id': conf.group_id,
+        'extended': 1,
+    }
+    for attempt in range(MAX_RETRIES):
+        await limiter.acquire()
+        try:
+            with span('fetch'):
+                async with session.get(f'{API}wall.get', params=params) as response:
+                    data = await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error = e
+        else:
+            if 'response' in data:
+                return data['response']
+            error = data.get('error') or {}
+            if error.get('error_code') not in TEMPORARY_ERRORS:
+                raise RuntimeError(f'VK error during backfill: {error}')
+        delay = min(2 ** attempt, 60)
+        logger.warning(f'Temporary error during backfill at offset {offset}: {error}, retrying in {delay}s')
+        await asyncio.sleep(delay)
+    raise RuntimeError(f'Backfill failed at offset {offset} after {MAX_RETRIES} attempts')
+
+
+@ThreadSwitcherWithDB.optimized
+async def get_until_id():
+    async with db_in_thread():
+        until_id = WallPost.get_last_wall_post_id()
+    return until_id
+
+
+@ThreadSwitcherWithDB.optimized
+async def store(items, profiles, until_id):
+    # Newer posts belong to the running service, it stores and sends them itself
+    items = [item for item in items if item['id'] <= until_id]
+    items = [item for item in items if item['from_id'] != conf.group_id]  # TODO fix repost, same as process_updates
+    async with db_in_thread():
+        with span('db_write'):
+            Profile.bulk_insert(profiles)
+            inserted = WallPost.bulk_insert(items, backfilled=True)
+            db.commit()
+    return inserted
+
+
+async def import_wall(session, batch_pages, until_id, restart=False):
+    checkpoint = Checkpoint()
+    if restart:
+        checkpoint.clear()
+    limiter = RateLimiter(PAGE_RATE)
+    total = (await get_page(session, limiter, 0))['count']
+    offset = checkpoint.load(total)
+    logger.info(f'Backfilling {total} posts starting from offset {offset}')
+    inserted = 0
+    while offset < total:
+        items, profiles = [], []
+        for _ in range(batch_pages):
+            page = await get_page(session, limiter, offset)
+            if not page['items']:
+                break
+            total = page['count']
+            items.extend(page['items'])
+            profiles.extend(page['profiles'])
+            offset += len(page['items'])
+            if offset >= total:
+                break
+        if not items:
+            break
+        inserted += await store(items, profiles, until_id)
+        checkpoint.save(offset, total)
+        logger.info(f'Backfilled {offset}/{total}, inserted {inserted}')
+    checkpoint.clear()
+    logger.info(f'Backfill finished, inserted {inserted} posts')
+
+
+@ThreadSwitcherWithDB.optimized
+async def post_unsent(bot, rate, until_id):
+    """ Send imported posts to the channel from the oldest one, throttled to `rate` posts per second
+    """
+    limiter = RateLimiter(rate)
+    after_id = 0
+    while True:
+        async with db_in_thread():
+            unsent = WallPost.get_unsent_ids(after_id, until_id)
+        if not unsent:
+            break
+        for wall_post_id in unsent:
+            async with limiter:
+                await send_post(bot, wall_post_id)
+        after_id = unsent[-1]
+
+
+async def main(args):
+    bot = ForwardBot()
+    try:
+        until_id = await get_until_id()
+        if until_id is None:
+            logger.error('DB is empty, start the service first, backfill imports posts older than the ones it stored')
+            return
+        await import_wall(bot.session, args.batch_pages, until_id, args.restart)
+        if args.post:
+            await post_unsent(bot, args.rate, until_id)
+    finally:
+        await bot.session.close()
+
+
+def run():
+    parser = argparse.ArgumentParser(description='Import whole wall of the group')
+    parser.add_argument('--batch-pages', type=int, default=10, help=f'pages of {PAGE_SIZE} posts per DB insert')
+    parser.add_argument('--restart', action='store_true', help='ignore saved checkpoint')
+    parser.add_argument('--post', action='store_true', help='send imported posts to the channel')
+    parser.add_argument('--rate', type=float, default=0.3, help='posts per second sent to the channel')
+    args = parser.parse_args()
+    init_logging()
+    logger.info('Running flforward backfill')
+    try:
+        asyncio.run(main(args))
+    except KeyboardInterrupt:
+        logger.info('Backfill interrupted, it will resume from the last checkpoint')
+    logger.remove()
+
+
+if __name__ == '__main__':
+    run()
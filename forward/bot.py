@@ -1,22 +1,44 @@
-from aiotg import Bot, Chat
+import asyncio
 
-from forward import conf
-from forward.model import Admin, db
+import aiohttp
+from aiotg import Bot, BotApiError, Chat
+from loguru import logger
+
+from forward import conf, profiling
+from forward.circuit import CircuitBreaker
+from forward.model import Admin, pool_status
 from forward.model.helpers import ThreadSwitcherWithDB, db_in_thread
+from forward.throttle import RateLimiter
+
+
+class AdminRegistry:
+    """ In-memory copy of registered admin chats, loaded once and kept in sync on registration
+    """
+
+    def __init__(self):
+        self.chat_ids = set()
 
+    def __iter__(self):
+        return iter(self.chat_ids)
 
-@ThreadSwitcherWithDB.optimized
-async def reg(chat: Chat, match):
-    async with db_in_thread():
-        admin = db.query(Admin).filter(Admin.chat_id == chat.id).one_or_none()
-    if admin:
-        await chat.send_text('You are already registered!')
-        return
-    async with db_in_thread():
-        admin = Admin(chat_id=chat.id)
-        db.add(admin)
-        db.commit()
-    await chat.send_text('You are successfully registered!')
+    def __contains__(self, chat_id):
+        return chat_id in self.chat_ids
+
+    @ThreadSwitcherWithDB.optimized
+    async def load(self):
+        async with db_in_thread():
+            chat_ids = Admin.get_chat_ids()
+        self.chat_ids = set(chat_ids)
+        logger.info(f'Loaded {len(self.chat_ids)} admins')
+
+    @ThreadSwitcherWithDB.optimized
+    async def register(self, chat_id):
+        if chat_id in self.chat_ids:
+            return False
+        async with db_in_thread():
+            created = Admin.upsert(chat_id)
+        self.chat_ids.add(chat_id)
+        return created
 
 
 async def get_chat_id(chat, match):
@@ -57,16 +79,67 @@ class ForwardBot:
     def __init__(self):
         self._bot = Bot(conf.bot_token, proxy=conf.tele_proxy)
         self.session = self._bot.session
-        self.loop = self._bot.loop
+        self.admins = AdminRegistry()
+        self.limiter = RateLimiter(conf.tg_rate_limit)
+        # Serializes processing of polled and pushed updates
+        self.tick_lock = asyncio.Lock()
+        self.vk_circuit = CircuitBreaker(
+            'vk', conf.circuit_failure_threshold, conf.circuit_recovery_timeout, catch_up=True
+        )
+        self.tg_circuit = CircuitBreaker('telegram', conf.circuit_failure_threshold, conf.circuit_recovery_timeout)
+        # Set up by the service on start
+        self.state = None
+        self.outbound = None
         self.init_handlers()
 
     def init_handlers(self):
-        self._bot.add_command(r'/reg', reg)
+        self._bot.add_command(r'/reg', self.reg)
         self._bot.add_command(r'/ch', get_chat_id)
+        self._bot.add_command(r'/pool', self.get_pool_status)
+        self._bot.add_command(r'/profile', self.toggle_profiler)
+
+    async def reg(self, chat: Chat, match):
+        if await self.admins.register(chat.id):
+            await chat.send_text('You are successfully registered!')
+        else:
+            await chat.send_text('You are already registered!')
+
+    async def get_pool_status(self, chat: Chat, match):
+        if chat.id not in self.admins:
+            return
+        status = ' '.join(f'{k}={v}' for k, v in pool_status().items())
+        await chat.send_text(f'DB pool: {status}')
+
+    async def toggle_profiler(self, chat: Chat, match):
+        if chat.id not in self.admins:
+            return
+        if profiling.profiler_running():
+            path = profiling.stop_profiler()
+            await chat.send_text(f'Profiler stopped: {path}')
+        else:
+            profiling.start_profiler()
+            await chat.send_text('Profiler started')
+
+    async def loop(self):
+        """ Receive updates, aiotg loop dies on the first failed getUpdates so it is restarted via telegram circuit
+        """
+        while True:
+            if not self.tg_circuit.allow():
+                await asyncio.sleep(self.tg_circuit.retry_in())
+                continue
+            try:
+                # Returns when the bot is stopped
+                return await self._bot.loop()
+            except (aiohttp.ClientError, asyncio.TimeoutError, BotApiError):
+                logger.exception('Error during receiving telegram updates')
+                self.tg_circuit.record_failure()
+
+    async def _notify(self, chat_id, text, **options):
+        async with self.limiter:
+            try:
+                await self._bot.send_message(chat_id, text, **options)
+            except BotApiError:
+                logger.exception(f'Error during notifying admin {chat_id}')
 
-    @ThreadSwitcherWithDB.optimized
     async def notify_admins(self, text, **options):
-        async with db_in_thread():
-            admins = db.query(Admin).all()
-        for admin in admins:
-            await self._bot.send_message(admin.chat_id, text, **options)
+        await asyncio.gather(*(self._notify(chat_id, text, **options) for chat_id in self.admins))
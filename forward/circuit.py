@@ -0,0 +1,78 @@
+import time
+
+from loguru import logger
+
+from forward.profiling import incr
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker:
+    """ Stops calls to an upstream after `failure_threshold` failures in a row
+
+    After `recovery_timeout` seconds a single probe call is allowed (half-open state),
+    its success closes the circuit and its failure opens it again.
+    With `catch_up` the outage is kept after closing until `recovered` is called, so work missed
+    during it is retried on every success until it is done.
+    """
+
+    def __init__(self, name, failure_threshold, recovery_timeout, catch_up=False):
+        self.name = name
+        self.catch_up = catch_up
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.outage_started_at = None
+
+    def retry_in(self):
+        """ Seconds left until the next probe is allowed
+        """
+        if self.state == CLOSED:
+            return 0
+        return max(0.0, self.opened_at + self.recovery_timeout - time.monotonic())
+
+    def allow(self):
+        if self.state == CLOSED:
+            return True
+        if self.retry_in():
+            return False
+        # One probe per recovery timeout, a lost probe does not block the circuit forever
+        logger.info(f'Circuit {self.name} is half-open, probing')
+        self.state = HALF_OPEN
+        self.opened_at = time.monotonic()
+        return True
+
+    def record_success(self):
+        """ Returns outage duration in seconds if this call closed the circuit or the outage is not recovered yet
+        """
+        self.failures = 0
+        if self.outage_started_at is None:
+            return
+        outage = time.monotonic() - self.outage_started_at
+        if self.state != CLOSED:
+            self.state = CLOSED
+            self.opened_at = None
+            logger.info(f'Circuit {self.name} is closed, upstream recovered after {outage:.1f}s')
+        if not self.catch_up:
+            self.recovered()
+        return outage
+
+    def recovered(self):
+        """ Work missed during the outage is done
+        """
+        self.outage_started_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+            if self.state == CLOSED:
+                incr(f'circuit_{self.name}_open')
+                if self.outage_started_at is None:
+                    self.outage_started_at = time.monotonic()
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+            logger.warning(f'Circuit {self.name} is open, next probe in {self.recovery_timeout}s')
@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import Dict, List, Optional
 
 bot_token: str
 log_file: str
@@ -13,10 +13,56 @@ stdout_log: Optional[bool] = False
 sql_log: Optional[bool] = False
 tele_proxy: Optional[str] = None
 root_dir: Optional[str] = None
+db_pool_size: Optional[int] = 5
+db_max_overflow: Optional[int] = 10
+db_pool_timeout: Optional[int] = 30
+db_pool_recycle: Optional[int] = 1800
+db_pool_pre_ping: Optional[bool] = True
+profile: Optional[bool] = False
+profile_file: Optional[str] = None
+profile_report_interval: Optional[int] = 60
+tg_rate_limit: Optional[int] = 25
+outbound_rate: Optional[float] = 1
+outbound_queue_size: Optional[int] = 500
+outbound_high_watermark: Optional[int] = 100
+state_file: Optional[str] = 'state.json'
+state_snapshot_interval: Optional[int] = 60
+shutdown_timeout: Optional[int] = 20
+mirror_channel_ids: Optional[List[int]] = None
+circuit_failure_threshold: Optional[int] = 3
+circuit_recovery_timeout: Optional[int] = 30
+catch_up_limit: Optional[int] = 1000
+outbound_max_attempts: Optional[int] = 5
+log_level: Optional[str] = 'DEBUG'
+log_async: Optional[bool] = True
+log_json: Optional[bool] = False
+log_buffering: Optional[int] = 8192
+log_rotation: Optional[str] = '1 week'
+log_retention: Optional[str] = None
+log_sampling: Optional[Dict[str, int]] = None
+ingest_mode: Optional[str] = None
+reconcile_interval: Optional[int] = 300
+group_token: Optional[str] = None
+callback_host: Optional[str] = '127.0.0.1'
+callback_port: Optional[int] = 8080
+callback_path: Optional[str] = '/vk'
+callback_secret: Optional[str] = None
+callback_confirmation: Optional[str] = None
+settings_watch_interval: Optional[int] = 5
 
+# Settings which are captured on start, reload keeps their old values until restart.
+# Stored posts, state and sent messages belong to group_id and channel_id, so they can't change
+# under running service either.
+RESTART_REQUIRED = {
+    'tele_proxy', 'db_uri', 'db_pool_size', 'db_max_overflow', 'db_pool_timeout', 'db_pool_recycle',
+    'db_pool_pre_ping', 'ingest_mode', 'callback_host', 'callback_port', 'callback_path', 'state_file', 'channel_id',
+    'group_id',
+}
 
-def read():
-    import dataclasses
+_subscribers = []
+
+
+def _read():
     import json
 
     from .model import Conf
@@ -26,10 +72,59 @@ def read():
         _settings = json.load(_settings)
     config = Conf.schema().load(_settings)
     config.root_dir = root_directory()
+    return config
+
+
+def _apply(config, keep=frozenset()):
+    """ Set module values from config except `keep` ones, returns set of changed keys including kept ones
+    """
+    import dataclasses
+
+    changed = set()
     for k in dataclasses.asdict(config).keys():
         v = getattr(config, k)
-        globals()[k] = v
+        if globals().get(k) != v:
+            changed.add(k)
+            if k not in keep:
+                globals()[k] = v
+    return changed
+
+
+def settings_mtime():
+    import os
+
+    from .utils import get_settings_path
+
+    return os.stat(get_settings_path()).st_mtime
+
+
+def on_reload(callback):
+    """ Register callback(changed_keys) called after settings are reloaded
+    """
+    _subscribers.append(callback)
+
+
+def reload():
+    """ Re-read and validate settings, apply them to this module and notify subscribers
+
+    Invalid settings raise and leave the current ones intact, RESTART_REQUIRED ones are reported but not applied.
+    If a subscriber fails, previous settings are restored and subscribers are notified again.
+    Returns set of changed keys.
+    """
+    import dataclasses
+
+    config = _read()
+    previous = {k: globals().get(k) for k in dataclasses.asdict(config).keys()}
+    changed = _apply(config, keep=RESTART_REQUIRED)
+    try:
+        for callback in _subscribers:
+            callback(changed)
+    except Exception:
+        globals().update(previous)
+        for callback in _subscribers:
+            callback(changed)
+        raise
+    return changed
 
 
-read()
-del globals()['read']
+_apply(_read())
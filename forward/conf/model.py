@@ -1,7 +1,35 @@
 from dataclasses import dataclass
-from typing import Optional
+from typing import Dict, List, Optional
 
 from dataclasses_json import dataclass_json
+from loguru import logger
+# loguru is pinned, its parsers tell which rotation and retention strings it accepts
+from loguru import _string_parsers as parsers
+
+# Zero or less would divide by zero in rate limiters or stall the loops using them
+POSITIVE = (
+    'interval', 'tg_rate_limit', 'outbound_rate', 'outbound_queue_size', 'outbound_high_watermark',
+    'outbound_max_attempts', 'circuit_failure_threshold', 'reconcile_interval',
+)
+# Zero or None disables the periodic job
+NON_NEGATIVE = (
+    'circuit_recovery_timeout', 'shutdown_timeout', 'profile_report_interval', 'state_snapshot_interval',
+    'settings_watch_interval',
+)
+
+
+def check_log_settings(level, rotation, retention):
+    """ loguru rejects bad values only after it removed current sinks, so they are checked upfront
+    """
+    logger.level(level)
+    # Same order as loguru tries them, parsers raise ValueError on malformed values too
+    if rotation is not None and all(
+        parse(rotation) is None
+        for parse in (parsers.parse_size, parsers.parse_duration, parsers.parse_frequency, parsers.parse_daytime)
+    ):
+        raise ValueError(f'log_rotation is not a size, duration or time, got {rotation}')
+    if retention is not None and parsers.parse_duration(retention) is None:
+        raise ValueError(f'log_retention is not a duration, got {retention}')
 
 
 @dataclass_json
@@ -21,3 +49,50 @@ class Conf:
     sql_log: Optional[bool] = False
     tele_proxy: Optional[str] = None
     root_dir: Optional[str] = None
+    db_pool_size: Optional[int] = 5
+    db_max_overflow: Optional[int] = 10
+    db_pool_timeout: Optional[int] = 30
+    db_pool_recycle: Optional[int] = 1800
+    db_pool_pre_ping: Optional[bool] = True
+    profile: Optional[bool] = False
+    profile_file: Optional[str] = None
+    profile_report_interval: Optional[int] = 60
+    tg_rate_limit: Optional[int] = 25
+    outbound_rate: Optional[float] = 1
+    outbound_queue_size: Optional[int] = 500
+    outbound_high_watermark: Optional[int] = 100
+    state_file: Optional[str] = 'state.json'
+    state_snapshot_interval: Optional[int] = 60
+    shutdown_timeout: Optional[int] = 20
+    mirror_channel_ids: Optional[List[int]] = None
+    circuit_failure_threshold: Optional[int] = 3
+    circuit_recovery_timeout: Optional[int] = 30
+    catch_up_limit: Optional[int] = 1000
+    outbound_max_attempts: Optional[int] = 5
+    log_level: Optional[str] = 'DEBUG'
+    log_async: Optional[bool] = True
+    log_json: Optional[bool] = False
+    log_buffering: Optional[int] = 8192
+    log_rotation: Optional[str] = '1 week'
+    log_retention: Optional[str] = None
+    log_sampling: Optional[Dict[str, int]] = None
+    ingest_mode: Optional[str] = None
+    reconcile_interval: Optional[int] = 300
+    group_token: Optional[str] = None
+    callback_host: Optional[str] = '127.0.0.1'
+    callback_port: Optional[int] = 8080
+    callback_path: Optional[str] = '/vk'
+    callback_secret: Optional[str] = None
+    callback_confirmation: Optional[str] = None
+    settings_watch_interval: Optional[int] = 5
+
+    def __post_init__(self):
+        for name in POSITIVE:
+            value = getattr(self, name)
+            if value is None or value <= 0:
+                raise ValueError(f'{name} must be positive, got {value}')
+        for name in NON_NEGATIVE:
+            value = getattr(self, name)
+            if value is not None and value < 0:
+                raise ValueError(f'{name} must not be negative, got {value}')
+        check_log_settings(self.log_level, self.log_rotation, self.log_retention)
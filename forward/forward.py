@@ -1,9 +1,14 @@
 import asyncio
 import datetime
+import hashlib
 import html
 import json
 import logging
+import signal
 import sys
+import time
+from collections import defaultdict
+from functools import partial
 from pathlib import Path
 from typing import Dict, List
 
@@ -12,248 +17,645 @@ from aiotg import BotApiError, Chat
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from loguru import logger
 
-from forward import conf
+from forward import conf, profiling
 from forward.bot import ChatEditMedia, ForwardBot
-from forward.model import Profile, WallPost, db
+from forward.model import Delivery, Profile, RenderState, TEXT_CHANGED, WallPost, channel_ids, db, pool_status
 from forward.model.helpers import ThreadSwitcherWithDB, db_in_thread
-from forward.model.utils import call_async
-
-
-def init_logging():
-    config = {
-        'handlers': [
-            {
-                'sink': Path(conf.root_dir) / conf.log_file,
-                'level': 'DEBUG'
-            },
-        ],
+from forward.outbound import COUNTER_EDIT, NEW_POST, OutboundScheduler, TEXT_EDIT
+from forward.profiling import incr, span
+from forward.state import State, state_path
+
+
+hot_logger = logger.bind(hot=True)
+
+
+class HotPathSampler:
+    """ Log filter keeping only one of every N hot path records, N is configured per level
+    """
+
+    def __init__(self, rates: Dict[str, int]):
+        self.rates = rates
+        self.seen = defaultdict(int)
+
+    def __call__(self, record):
+        if not record['extra'].get('hot'):
+            return True
+        level = record['level'].name
+        rate = self.rates.get(level)
+        if not rate or rate <= 1:
+            return True
+        seen = self.seen[level]
+        self.seen[level] = seen + 1
+        return seen % rate == 0
+
+
+def configure_logging():
+    """ Set up sinks and levels from conf, can be called again to apply changed settings
+    """
+    common = {
+        'level': conf.log_level,
+        # With enqueue records are formatted and written by a loguru worker thread, not the event loop
+        'enqueue': conf.log_async,
+        'serialize': conf.log_json,
     }
+    file_sink = {
+        'sink': Path(conf.root_dir) / conf.log_file,
+        'rotation': conf.log_rotation,
+        'retention': conf.log_retention,
+        'filter': HotPathSampler(conf.log_sampling or {}),
+        **common,
+    }
+    if conf.log_async:
+        # Batch writes, the worker thread is the only writer so a larger buffer is safe
+        file_sink['buffering'] = conf.log_buffering
+    config = {'handlers': [file_sink]}
     if conf.stdout_log:
-        config['handlers'].append({'sink': sys.stdout, 'level': 'DEBUG', 'rotation': '1 week'})
+        config['handlers'].append({'sink': sys.stdout, 'filter': HotPathSampler(conf.log_sampling or {}), **common})
     logger.configure(**config)
+    logging.getLogger().setLevel(conf.log_level)
+    logging.getLogger('sqlalchemy').setLevel(logging.DEBUG if conf.sql_log else logging.WARNING)
+
+
+def init_logging():
+    configure_logging()
 
     class InterceptHandler(logging.Handler):
         def emit(self, record):
             logger_opt = logger.opt(depth=6, exception=record.exc_info)
             logger_opt.log(record.levelname, record.getMessage())
 
-    logging.getLogger().setLevel(logging.DEBUG)
-    if conf.sql_log:
-        logging.getLogger('sqlalchemy').setLevel(logging.DEBUG)
     logging.getLogger().addHandler(InterceptHandler())
 
 
 API = 'https://api.vk.com/method/'
 
-params = {
-    'access_token': conf.access_token,
-    'v': conf.api_version,
-    'count': 20,
-    'owner_id': conf.group_id,
-    'extended': 1,
-}
 
+def wall_params():
+    # Built on every call, so reloaded settings apply to the next request
+    return {
+        'access_token': conf.access_token,
+        'v': conf.api_version,
+        'count': 20,
+        'owner_id': conf.group_id,
+        'extended': 1,
+    }
+
+
+class VkApiError(RuntimeError):
+    pass
+
+
+async def fetch(session, **options):
+    with span('fetch'):
+        async with session.get(f'{API}wall.get', params={**wall_params(), **options}) as response:
+            with span('decode'):
+                data = await response.json()
+    if 'response' not in data:
+        raise VkApiError(data.get('error'))
+    return data['response']
 
-async def fetch(session):
-    async with session.get(f'{API}wall.get', params=params) as response:
-        return await response.json()
+
+async def fetch_missed(session, last_wall_post_id):
+    """ Page through the wall down to the last known post, bounded by conf.catch_up_limit posts
+    """
+    items = {}
+    profiles = {}
+    offset = 0
+    while offset < conf.catch_up_limit:
+        page = await fetch(session, offset=offset, count=100)
+        # Posts published meanwhile shift the wall down, so pages overlap
+        items.update((item['id'], item) for item in page['items'])
+        profiles.update((profile['id'], profile) for profile in page['profiles'])
+        offset += len(page['items'])
+        fresh = [item['id'] for item in page['items'] if not item.get('is_pinned')]
+        if not fresh or min(fresh) <= last_wall_post_id or offset >= page['count']:
+            break
+    return {'items': list(items.values()), 'profiles': list(profiles.values())}
 
 
 async def ask(session: aiohttp.ClientSession, bot):
-    try:
-        response = await session.get(f'{API}wall.get', params=params)
-    except Exception:
-        logger.exception(f'Exception during wall check')
+    if bot.outbound.backpressure:
+        logger.warning(f'Outbound queue is backed up ({len(bot.outbound)}), skipping wall check')
+        incr('backpressure_skip')
         return
-    data = await response.json()
-    logger.debug(f'Total: {data["response"]["count"]}')
-    await process_updates(data['response'], bot)
+    if not bot.vk_circuit.allow():
+        logger.info(f'VK circuit is open, skipping wall check for {bot.vk_circuit.retry_in():.0f}s')
+        return
+    with span('tick'):
+        try:
+            data = await fetch(session)
+        except Exception:
+            logger.exception(f'Exception during wall check')
+            bot.vk_circuit.record_failure()
+            return
+        outage = bot.vk_circuit.record_success()
+        logger.debug(f'Total: {data["count"]}')
+        logger.debug(f'DB pool: {pool_status()}')
+        async with bot.tick_lock:
+            if outage is not None:
+                await catch_up(session, bot, outage)
+            else:
+                await process_updates(data, bot)
+
+
+async def catch_up(session, bot, outage):
+    """ Fetch everything posted during VK outage, new posts are queued in order and drained at the outbound rate
+
+    The outage is cleared only when this succeeds, otherwise the next successful call catches up again.
+    """
+    start = time.monotonic()
+    with span('catch_up'):
+        try:
+            data = await fetch_missed(session, bot.state.last_wall_post_id or 0)
+        except Exception:
+            logger.exception('Exception during catch up')
+            bot.vk_circuit.record_failure()
+            return
+        await process_updates(data, bot)
+    bot.vk_circuit.recovered()
+    logger.info(
+        f'Caught up {len(data["items"])} posts after {outage:.1f}s outage in {time.monotonic() - start:.1f}s, '
+        f'{len(bot.outbound)} messages queued'
+    )
 
 
 @ThreadSwitcherWithDB.optimized
-async def process_updates(data: Dict, bot):
+async def process_updates(data: Dict, bot, new_ids=frozenset()):
+    """ Store new posts and queue them for sending, diff the rest against DB
+
+    New posts are ones above the cursor and `new_ids` announced by pushed wall_post_new events,
+    which may come out of order. Other unknown posts (e.g. liked old ones) are not sent.
+    """
     to_send = []
     to_update = []
+    if not data['items']:
+        return
+    new_items = []
+    state = bot.state
+    last_wall_post_id = state.last_wall_post_id
     async with db_in_thread():
-        last_wall_post_id = WallPost.get_last_wall_post_id()
-        if not last_wall_post_id:
-            last_wall_post_id = 0
-        if max(item['id'] for item in data['items']) <= last_wall_post_id:
+        if last_wall_post_id is None:
+            with span('db_read'):
+                last_wall_post_id = WallPost.get_last_wall_post_id()
+        with span('db_read'):
+            existing_ids = set(WallPost.get_existing_ids([item['id'] for item in data['items']]))
+        for item in data['items']:
+            is_new = item['id'] > (last_wall_post_id or 0) or item['id'] in new_ids
+            if is_new and item['id'] not in existing_ids:
+                new_items.append(item)
+            else:
+                to_update.append(item)
+        if not new_items:
             logger.info('No new updates')
-            to_update = data['items']
         else:
-            for item in data['profiles']:
-                profile = Profile.create_from_item(item)
-                db.add(profile)
-            for item in data['items']:
-                if item['id'] > last_wall_post_id:
+            with span('db_write'):
+                for item in data['profiles']:
+                    if item['id'] in state.profile_ids:
+                        continue
+                    profile = Profile.create_from_item(item)
+                    db.add(profile)
+                for item in new_items:
                     if item['from_id'] == conf.group_id:
                         continue  # TODO fix repost
                     post = WallPost.create_from_item(item)
                     db.add(post)
                     to_send.append(item['id'])
-                else:
-                    to_update.append(item)
-            db.commit()
+                db.commit()
+    # State is read by snapshots on the loop, so it is changed only there
+    if new_items:
+        state.profile_ids.update(item['id'] for item in data['profiles'])
+        state.remember(item for item in new_items if item['id'] in to_send)
+    if to_send:
+        last_wall_post_id = max(last_wall_post_id or 0, *to_send)
+    state.last_wall_post_id = last_wall_post_id
     if to_update:
         await update_existing(to_update, bot)
     if to_send:
-        await send_updates(to_send, bot)
+        send_updates(to_send, bot)
 
 
 def render_message(post: WallPost):
-    logger.info('Render message')
-    user = post.profile
-    message = post.text or '>'
-    message = html.escape(message)
-    who = f'<a href="{user.profile_link}">{user.first_name} {user.last_name}</a>'
-    original = f'<a href="{post.source}">@wall</a>'
-    text = f'{who} {original} ❤{post.likes} ✒{post.comments}'
-    text = f'{text}\n{message}'
+    hot_logger.debug('Render message')
+    with span('render'):
+        user = post.profile
+        message = post.text or '>'
+        message = html.escape(message)
+        who = f'<a href="{user.profile_link}">{user.first_name} {user.last_name}</a>'
+        original = f'<a href="{post.source}">@wall</a>'
+        text = f'{who} {original} ❤{post.likes} ✒{post.comments}'
+        text = f'{text}\n{message}'
     return text
 
 
+def render_digest(text, photos):
+    """ Fingerprint of the rendered message, used to skip edits which would not change it
+    """
+    media = [photo['media'] for photo in photos or []]
+    return hashlib.sha1(json.dumps([text, media]).encode()).hexdigest()
+
+
 @ThreadSwitcherWithDB.optimized
 async def update_existing(to_update: List[Dict], bot):
-    to_update = {item['id']: item for item in to_update}
+    to_update = {item['id']: item for item in to_update if not bot.state.is_unchanged(item)}
+    if not to_update:
+        logger.info('Existing posts are not changed')
+        return
     to_update_str = ' '.join(str(i) for i in to_update)
     logger.info(f'Updating existing: {to_update_str}')
     to_update_send = []
+    changed_items = []
     async with db_in_thread():
-        posts_to_update = WallPost.get_existing_to_update(list(to_update.keys()))
-        for post in posts_to_update:
-            if post.update_existing(to_update[post.wall_post_id]):
-                to_update_send.append(post.wall_post_id)
-        db.commit()
-    to_update_send_str = ' '.join(str(i) for i in to_update_send)
+        with span('db_read'):
+            records = WallPost.get_records(list(to_update.keys()))
+        with span('db_write'):
+            for record in records:
+                item = to_update[record.wall_post_id]
+                changed = record.diff(item)
+                if not changed:
+                    continue
+                changed_items.append(item)
+                # Posts imported by backfill or still queued for sending have no message yet
+                if record.message_id:
+                    to_update_send.append((record.wall_post_id, changed))
+            WallPost.bulk_update(changed_items)
+            db.commit()
+    bot.state.remember(to_update.values())
+    to_update_send_str = ' '.join(str(i) for i, _ in to_update_send)
     logger.info(f'Modified entities: {to_update_send_str}')
-    if to_update_send:
-        async with db_in_thread():
-            posts_to_update_send = WallPost.get_existing_to_update(to_update_send, load_profiles=True)
-        for post in posts_to_update_send:
-            await EditSender(bot, post)()
+    for wall_post_id, changed in to_update_send:
+        bot.outbound.submit(TEXT_EDIT if changed == TEXT_CHANGED else COUNTER_EDIT, wall_post_id)
+
+
+def is_not_modified(error: BotApiError):
+    return 'message is not modified' in str(error)
+
+
+def largest_file_id(message):
+    photo = message.get('photo') if isinstance(message, dict) else None
+    return photo[-1]['file_id'] if photo else None
+
+
+async def fan_out(send, chat_ids):
+    """ Deliver to the first chat alone, so it can share uploaded media, then to the rest concurrently
+
+    Returns chat_id -> result of send and the first exception raised by sends to the rest of chats.
+    """
+    if not chat_ids:
+        return {}, None
+    first, *rest = chat_ids
+    results = {first: await send(first)}
+    error = None
+    sends = await asyncio.gather(*(send(chat_id) for chat_id in rest), return_exceptions=True)
+    for chat_id, result in zip(rest, sends):
+        if isinstance(result, Exception):
+            error = error or result
+        else:
+            results[chat_id] = result
+    return results, error
 
 
 class EditSender:
     def __init__(self, bot: ForwardBot, post: WallPost):
-        self.chat = ChatEditMedia(bot._bot, conf.channel_id)
+        self.bot = bot
         self.photos = post.photo_attachments
         self.post = post
         self.text = render_message(post)
+        self.digest = render_digest(self.text, self.photos)
 
-    async def edit_text(self):
+    async def edit_text(self, chat, message_id):
         try:
-            await self.chat.edit_text(
-                self.post.message_id,
-                text=render_message(self.post),
+            await chat.edit_text(
+                message_id,
+                text=self.text,
                 parse_mode='HTML',
                 disable_web_page_preview=True
             )
-        except BotApiError:
-            logger.warning('ApiError: probably message is not modified!')
-
-    async def edit_media(self):
-        self.photos[0]['caption'] = self.text
-        self.photos[0]['parse_mode'] = 'HTML'
+        except BotApiError as e:
+            if is_not_modified(e):
+                return True
+            logger.warning(f'ApiError during editing text: {e}')
+            return False
+        return True
+
+    async def edit_media(self, chat, message_id):
+        media = dict(self.photos[0], caption=self.text, parse_mode='HTML')
         try:
-            await self.chat.edit_message_media(self.post.message_id, media=json.dumps(self.photos[0]))
-        except BotApiError:
-            logger.error('Error during editing media')
-
-    async def __call__(self):
-        if self.photos:
-            logger.info(f'Editing message media {self.post.message_id}')
-            await self.edit_media()
-        else:
-            logger.info(f'Editing message text {self.post.message_id}')
-            await self.edit_text()
+            result = await chat.edit_message_media(message_id, media=json.dumps(media))
+        except BotApiError as e:
+            if is_not_modified(e):
+                return True
+            logger.error(f'Error during editing media: {e}')
+            return False
+        # Other channels reuse the photo uploaded by telegram instead of fetching it from VK again
+        self.photos[0]['media'] = largest_file_id(result['result']) or self.photos[0]['media']
+        return True
+
+    async def __call__(self, chat_id, message_id, last_digest=None):
+        """ Returns True if the message was brought in sync with the post, False on failure, None if already in sync
+        """
+        if self.digest == last_digest:
+            logger.info(f'Message {chat_id}/{message_id} is not modified, skipping edit')
+            incr('edit_skipped')
+            return
+        chat = ChatEditMedia(self.bot._bot, chat_id)
+        with span('send'):
+            if self.photos:
+                logger.info(f'Editing message media {chat_id}/{message_id}')
+                return await self.edit_media(chat, message_id)
+            else:
+                logger.info(f'Editing message text {chat_id}/{message_id}')
+                return await self.edit_text(chat, message_id)
 
 
 class UpdatesSender:
-    def __init__(self, bot, loop, item):
-        self.loop = loop
+    def __init__(self, bot, item):
+        self.bot = bot
         self.text = render_message(item)
         self.photos = item.photo_attachments
+        self.digest = render_digest(self.text, self.photos)
         self.likes = item.likes
         self.comments = item.comments
-        self.chat = Chat(bot._bot, conf.channel_id)
 
-    def send_photos(self):
+    async def send_photos(self, chat):
         if len(self.text) > 1024:
             text = 'TOO LONG DESCRIPTION'
         else:
             text = self.text
-        self.photos[0]['caption'] = text
-        self.photos[0]['parse_mode'] = 'HTML'
+        photos = [dict(photo) for photo in self.photos]
+        photos[0]['caption'] = text
+        photos[0]['parse_mode'] = 'HTML'
         try:
-            result = call_async(
-                self.loop,
-                lambda: self.chat.send_media_group(
-                    media=json.dumps(self.photos),
-                    disable_web_page_preview=True
-                )
+            result = await chat.send_media_group(
+                media=json.dumps(photos),
+                disable_web_page_preview=True
             )
-        except Exception:
+        except BotApiError:
             logger.exception('Error during sending new post!')
             return
+        # Other channels reuse the photos uploaded by telegram instead of fetching them from VK again
+        for photo, message in zip(self.photos, result['result']):
+            photo['media'] = largest_file_id(message) or photo['media']
         return result['result'][0]['message_id']
 
-    def send_text(self):
+    async def send_text(self, chat):
         try:
-            result = call_async(
-                self.loop,
-                lambda: self.chat.send_text(
-                    self.text,
-                    disable_web_page_preview=True,
-                    parse_mode='HTML',
-                )
+            result = await chat.send_text(
+                self.text,
+                disable_web_page_preview=True,
+                parse_mode='HTML',
             )
-        except Exception:
+        except BotApiError:
             logger.exception('Error during sending new post!')
             return
         return result['result']['message_id']
 
-    def __call__(self):
-        if self.photos:
-            return self.send_photos()
-        else:
-            return self.send_text()
-
-
-def _send_updates(updates, bot, to_sleep, loop):
-    updates = WallPost.get_updates(updates)
-    for item in updates:
-        message_id = UpdatesSender(bot, loop, item)()
-        if message_id:
-            item.message_id = message_id
-            db.add(item)
-    db.commit()
-    # if to_sleep:
-    #     logger.info('Sleeping since there are multiple messages..')
-    #     await asyncio.sleep(1)
-
-
-async def send_updates(updates, bot):
-    to_sleep = False
-    if len(updates) > 1:
-        to_sleep = True
+    async def __call__(self, chat_id):
+        chat = Chat(self.bot._bot, chat_id)
+        with span('send'):
+            if self.photos:
+                return await self.send_photos(chat)
+            else:
+                return await self.send_text(chat)
+
+
+@ThreadSwitcherWithDB.optimized
+async def send_post(bot, wall_post_id):
+    """ Returns False if the post was not delivered to some channels, transport errors are raised
+    """
+    async with db_in_thread():
+        with span('db_read'):
+            posts = WallPost.get_updates([wall_post_id])
+            delivered = Delivery.get_message_ids(wall_post_id)
+    if not posts:
+        return True
+    post = posts[0]
+    if post.message_id:
+        delivered[conf.channel_id] = post.message_id
+    to_send = [chat_id for chat_id in channel_ids() if chat_id not in delivered]
+    if not to_send:
+        return True
+    sender = UpdatesSender(bot, post)
+    results, error = await fan_out(sender, to_send)
+    sent = {chat_id: message_id for chat_id, message_id in results.items() if message_id}
+    if sent:
+        async with db_in_thread():
+            with span('db_write'):
+                for chat_id, message_id in sent.items():
+                    RenderState.save_digests(chat_id, {message_id: sender.digest})
+                if conf.channel_id in sent:
+                    WallPost.set_message_id(wall_post_id, sent.pop(conf.channel_id))
+                Delivery.save(wall_post_id, sent)
+                db.commit()
+    if error:
+        raise error
+    return len(results) == len(to_send) and all(results.values())
+
+
+@ThreadSwitcherWithDB.optimized
+async def edit_post(bot, wall_post_id):
+    """ Returns False if the post was not edited in some channels, transport errors are raised
+    """
+    async with db_in_thread():
+        with span('db_read'):
+            post = WallPost.get_existing_to_update([wall_post_id], load_profiles=True).one_or_none()
+            delivered = Delivery.get_message_ids(wall_post_id)
+            if post is not None and post.message_id:
+                delivered[conf.channel_id] = post.message_id
+            digests = {
+                chat_id: RenderState.get_digests(chat_id, [message_id]).get(message_id)
+                for chat_id, message_id in delivered.items()
+            }
+    if post is None or not delivered:
+        return True
+    sender = EditSender(bot, post)
+    chat_ids = [chat_id for chat_id in channel_ids() if chat_id in delivered]
+    results, error = await fan_out(lambda chat_id: sender(chat_id, delivered[chat_id], digests[chat_id]), chat_ids)
+    edited = [chat_id for chat_id, ok in results.items() if ok]
+    if edited:
+        async with db_in_thread():
+            with span('db_write'):
+                for chat_id in edited:
+                    RenderState.save_digests(chat_id, {delivered[chat_id]: sender.digest})
+                db.commit()
+    if error:
+        raise error
+    return len(results) == len(chat_ids) and False not in results.values()
+
+
+def send_updates(updates, bot):
     updates_str = ' '.join(str(i) for i in updates)
     logger.info(f'Sending new messages : {updates_str}')
-    loop = asyncio.get_event_loop()
-    await loop.run_in_executor(None, lambda: _send_updates(updates, bot, to_sleep, loop))
+    for wall_post_id in sorted(updates):
+        bot.outbound.submit(NEW_POST, wall_post_id)
+
+
+@ThreadSwitcherWithDB.optimized
+async def load_state():
+    path = state_path()
+    state = State.load(path)
+    async with db_in_thread():
+        state.validate()
+    logger.info(
+        f'Loaded state from {path}: cursor {state.last_wall_post_id}, {len(state.fingerprints)} fingerprints, '
+        f'{sum(len(ids) for ids in state.pending.values())} pending jobs'
+    )
+    return state
+
+
+@ThreadSwitcherWithDB.optimized
+async def requeue_unsent(bot):
+    """ Queue stored posts which never reached the main channel, e.g. lost on crash or given up on
+    """
+    async with db_in_thread():
+        unsent = WallPost.get_unsent_ids(limit=conf.outbound_queue_size, backfilled=False)
+    if unsent:
+        send_updates(unsent, bot)
+
+
+def save_state(bot):
+    bot.state.pending = bot.outbound.snapshot()
+    with span('snapshot'):
+        bot.state.dump(state_path())
+
+
+async def save_state_job(bot):
+    # Coroutine job runs on the loop, so the outbound queue is not mutated while it is saved
+    save_state(bot)
+
+
+def reload_settings():
+    try:
+        changed = conf.reload()
+    except Exception:
+        logger.exception('Settings are not reloaded, keeping the current ones')
+        return
+    logger.info(f'Settings reloaded, changed: {", ".join(sorted(changed)) or "nothing"}')
+
+
+class SettingsWatcher:
+    def __init__(self):
+        self.mtime = conf.settings_mtime()
+
+    async def check(self):
+        try:
+            mtime = conf.settings_mtime()
+        except OSError:
+            logger.exception('Settings file is not available')
+            return
+        if mtime != self.mtime:
+            self.mtime = mtime
+            reload_settings()
+
+
+def schedule_job(scheduler, job_id, func, seconds, args=(), **options):
+    """ Add, reschedule or remove (if seconds is falsy) interval job
+    """
+    job = scheduler.get_job(job_id)
+    if not seconds:
+        if job is not None:
+            job.remove()
+    elif job is None:
+        scheduler.add_job(func, 'interval', args, id=job_id, seconds=seconds, **options)
+    elif job.trigger.interval.total_seconds() != seconds:
+        job.reschedule('interval', seconds=seconds)
+
+
+def schedule_jobs(scheduler, bot, push, watcher):
+    # With push ingestion polling only reconciles missed events
+    interval = conf.reconcile_interval if push else conf.interval
+    schedule_job(scheduler, 'ask', ask, interval, (bot.session, bot), next_run_time=datetime.datetime.now())
+    schedule_job(scheduler, 'profiling_report', profiling.report, conf.profile_report_interval)
+    schedule_job(scheduler, 'save_state', save_state_job, conf.state_snapshot_interval, (bot,))
+    # A coroutine function, so APScheduler runs it on the loop and awaits it
+    schedule_job(scheduler, 'watch_settings', watcher.check, conf.settings_watch_interval)
+
+
+def apply_settings(bot, scheduler, push, watcher, changed):
+    """ Apply reloaded settings to running components, in-flight work is not interrupted
+    """
+    restart_required = changed & conf.RESTART_REQUIRED
+    if restart_required:
+        logger.warning(f'Changed settings need a restart to apply: {", ".join(sorted(restart_required))}')
+    if any(key.startswith('log_') or key in ('stdout_log', 'sql_log') for key in changed):
+        configure_logging()
+    # aiotg builds the API url from the token on every call
+    bot._bot.api_token = conf.bot_token
+    bot.limiter.rate = conf.tg_rate_limit
+    bot.outbound.limiter.rate = conf.outbound_rate
+    bot.outbound.capacity = conf.outbound_queue_size
+    bot.outbound.high_watermark = conf.outbound_high_watermark
+    bot.outbound.max_attempts = conf.outbound_max_attempts
+    for circuit in (bot.vk_circuit, bot.tg_circuit):
+        circuit.failure_threshold = conf.circuit_failure_threshold
+        circuit.recovery_timeout = conf.circuit_recovery_timeout
+    if 'profile' in changed:
+        if conf.profile:
+            profiling.start_profiler()
+        else:
+            profiling.stop_profiler()
+    if scheduler is not None:
+        schedule_jobs(scheduler, bot, push, watcher)
 
 
 async def main(run_scheduler=True):
     bot = ForwardBot()
+    await bot.admins.load()
+    bot.state = await load_state()
+    bot.outbound = OutboundScheduler(
+        {
+            NEW_POST: partial(send_post, bot),
+            TEXT_EDIT: partial(edit_post, bot),
+            COUNTER_EDIT: partial(edit_post, bot),
+        },
+        rate=conf.outbound_rate,
+        capacity=conf.outbound_queue_size,
+        high_watermark=conf.outbound_high_watermark,
+        circuit=bot.tg_circuit,
+        max_attempts=conf.outbound_max_attempts,
+    )
+    bot.outbound.restore(bot.state.pending)
+    await requeue_unsent(bot)
+    outbound_loop = asyncio.create_task(bot.outbound.run())
+    if conf.profile:
+        profiling.start_profiler()
+    ingest_tasks = []
+    if conf.ingest_mode:
+        from forward.ingest import start_ingestion
+        ingest_tasks = start_ingestion(bot)
+    push = bool(ingest_tasks)
+    watcher = SettingsWatcher()
+    scheduler = None
     if run_scheduler:
         scheduler = AsyncIOScheduler()
         scheduler.start()
-        scheduler.add_job(
-            ask, 'interval', (bot.session, bot),
-            seconds=conf.interval, next_run_time=datetime.datetime.now()
-        )
+        schedule_jobs(scheduler, bot, push, watcher)
+    conf.on_reload(partial(apply_settings, bot, scheduler, push, watcher))
     bot_loop = asyncio.create_task(bot.loop())
-    await asyncio.wait([bot_loop, ])
+
+    stop = asyncio.Event()
+    loop = asyncio.get_event_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    loop.add_signal_handler(signal.SIGHUP, reload_settings)
+    stopper = asyncio.create_task(stop.wait())
+    await asyncio.wait([stopper, bot_loop, outbound_loop, *ingest_tasks], return_when=asyncio.FIRST_COMPLETED)
+
+    logger.info('Shutting down..')
+    if scheduler is not None:
+        scheduler.pause()
+    async with bot.tick_lock:
+        # The running tick finished and enqueued its sends, cancelling it earlier could interrupt its DB commit
+        if scheduler is not None:
+            scheduler.shutdown(wait=False)
+        for task in ingest_tasks:
+            task.cancel()
+    bot._bot.stop()
+    bot_loop.cancel()
+    if not await bot.outbound.drain(conf.shutdown_timeout):
+        logger.warning(f'Outbound queue is not drained, {len(bot.outbound)} jobs left for the next start')
+    outbound_loop.cancel()
+    save_state(bot)
+    await asyncio.gather(bot_loop, outbound_loop, *ingest_tasks, return_exceptions=True)
 
 
 def run():
@@ -262,7 +664,11 @@ def run():
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
-        logger.info('Shutting down..')
+        logger.info('Interrupted')
+    profiling.stop_profiler()
+    profiling.report()
+    # Flushes queued records and closes the sinks
+    logger.remove()
 
 
 if __name__ == '__main__':
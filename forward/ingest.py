@@ -0,0 +1,218 @@
+import asyncio
+from typing import Dict, Set
+
+from aiohttp import web
+from loguru import logger
+
+from forward import conf
+from forward.forward import API, catch_up, process_updates
+from forward.profiling import incr
+
+# Callback API / Bots Long Poll events which touch a wall post of the group
+POST_EVENTS = {'wall_post_new'}
+REPLY_EVENTS = {'wall_reply_new', 'wall_reply_edit', 'wall_reply_delete', 'wall_reply_restore'}
+LIKE_EVENTS = {'like_add', 'like_remove'}
+
+
+def post_id_from_event(event: Dict):
+    """ Returns id of the group wall post affected by VK event or None
+    """
+    event_type = event.get('type')
+    obj = event.get('object') or {}
+    if event_type in POST_EVENTS:
+        if obj.get('owner_id') != conf.group_id or obj.get('post_type', 'post') != 'post':
+            return
+        return obj.get('id')
+    if event_type in REPLY_EVENTS:
+        if obj.get('post_owner_id', conf.group_id) != conf.group_id:
+            return
+        return obj.get('post_id')
+    if event_type in LIKE_EVENTS:
+        if obj.get('object_type') != 'post' or obj.get('object_owner_id') != conf.group_id:
+            return
+        return obj.get('object_id')
+
+
+class EventDispatcher:
+    """ Collects ids of posts touched by pushed events and feeds fresh copies of them into process_updates
+
+    Ids are coalesced, so a burst of events for the same posts results in a single wall.getById call.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.pending: Set[int] = set()
+        # Posts announced by wall_post_new, only they are sent as new when below the cursor
+        self.new_ids: Set[int] = set()
+        self.ready = asyncio.Event()
+
+    def feed(self, event: Dict):
+        incr(f'event_{event.get("type")}')
+        post_id = post_id_from_event(event)
+        if post_id is None:
+            return
+        if event.get('type') in POST_EVENTS:
+            self.new_ids.add(post_id)
+        self.pending.add(post_id)
+        self.ready.set()
+
+    async def fetch_posts(self, post_ids):
+        params = {
+            'access_token': conf.access_token,
+            'v': conf.api_version,
+            'extended': 1,
+            'posts': ','.join(f'{conf.group_id}_{post_id}' for post_id in post_ids),
+        }
+        async with self.bot.session.get(f'{API}wall.getById', params=params) as response:
+            return await response.json()
+
+    async def run(self):
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            # wall.getById accepts up to 100 posts at once
+            post_ids = sorted(self.pending)[:100]
+            self.pending.difference_update(post_ids)
+            if self.pending:
+                self.ready.set()
+            circuit = self.bot.vk_circuit
+            if not circuit.allow():
+                # Keep the ids, they are fetched once VK is back
+                self.pending.update(post_ids)
+                await asyncio.sleep(circuit.retry_in())
+                self.ready.set()
+                continue
+            logger.info(f'Pushed updates for: {" ".join(str(i) for i in post_ids)}')
+            try:
+                data = await self.fetch_posts(post_ids)
+            except Exception:
+                logger.exception('Exception during fetching pushed posts')
+                circuit.record_failure()
+                self.pending.update(post_ids)
+                self.ready.set()
+                continue
+            if 'response' not in data:
+                logger.error(f'VK error during fetching pushed posts: {data.get("error")}')
+                circuit.record_failure()
+                self.pending.update(post_ids)
+                self.ready.set()
+                continue
+            outage = circuit.record_success()
+            new_ids = self.new_ids.intersection(post_ids)
+            self.new_ids.difference_update(new_ids)
+            async with self.bot.tick_lock:
+                # Catch up first, pushed posts would move the cursor past everything missed during the outage
+                if outage is not None:
+                    await catch_up(self.bot.session, self.bot, outage)
+                await process_updates(data['response'], self.bot, new_ids)
+
+
+class CallbackServer:
+    """ Local endpoint for VK Callback API
+
+    It also accepts any locally posted event of the same shape, which makes it usable as a fake event source:
+    curl -d '{"type": "wall_post_new", "object": {"id": 1, "owner_id": -1}}' http://127.0.0.1:8080/vk
+    """
+
+    def __init__(self, dispatcher: EventDispatcher):
+        self.dispatcher = dispatcher
+        self.runner = None
+
+    async def handle(self, request: web.Request):
+        try:
+            event = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        if conf.callback_secret and event.get('secret') != conf.callback_secret:
+            logger.warning('Callback event with wrong secret')
+            return web.Response(status=403)
+        if event.get('type') == 'confirmation':
+            return web.Response(text=conf.callback_confirmation or '')
+        self.dispatcher.feed(event)
+        # VK expects exactly "ok", otherwise it keeps retrying the event
+        return web.Response(text='ok')
+
+    async def run(self):
+        app = web.Application()
+        app.router.add_post(conf.callback_path, self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, conf.callback_host, conf.callback_port)
+        await site.start()
+        logger.info(f'Listening for VK callbacks on {conf.callback_host}:{conf.callback_port}{conf.callback_path}')
+        try:
+            while True:
+                await asyncio.sleep(3600)
+        finally:
+            await self.runner.cleanup()
+
+
+class LongPoll:
+    """ Bots Long Poll client, requires a community token in conf.group_token
+    """
+
+    wait = 25
+
+    def __init__(self, dispatcher: EventDispatcher, session):
+        self.dispatcher = dispatcher
+        self.session = session
+        self.server = None
+        self.key = None
+        self.ts = None
+
+    async def get_server(self):
+        params = {
+            'access_token': conf.group_token,
+            'v': conf.api_version,
+            'group_id': abs(conf.group_id),
+        }
+        async with self.session.get(f'{API}groups.getLongPollServer', params=params) as response:
+            data = await response.json()
+        if 'response' not in data:
+            raise RuntimeError(f'VK error during getting long poll server: {data.get("error")}')
+        self.server = data['response']['server']
+        self.key = data['response']['key']
+        self.ts = data['response']['ts']
+
+    async def check(self):
+        params = {'act': 'a_check', 'key': self.key, 'ts': self.ts, 'wait': self.wait}
+        timeout = self.wait + 10
+        async with self.session.get(self.server, params=params, timeout=timeout) as response:
+            data = await response.json()
+        failed = data.get('failed')
+        if failed == 1:
+            # History is partially lost, reconciliation poll will catch up
+            self.ts = data['ts']
+        elif failed in (2, 3):
+            self.server = None
+        elif not failed:
+            self.ts = data['ts']
+            for event in data.get('updates', []):
+                self.dispatcher.feed(event)
+
+    async def run(self):
+        while True:
+            try:
+                if self.server is None:
+                    await self.get_server()
+                await self.check()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Exception during long poll')
+                self.server = None
+                await asyncio.sleep(5)
+
+
+def start_ingestion(bot):
+    """ Start push ingestion configured by conf.ingest_mode, returns running tasks
+    """
+    dispatcher = EventDispatcher(bot)
+    tasks = [asyncio.create_task(dispatcher.run())]
+    if conf.ingest_mode == 'callback':
+        tasks.append(asyncio.create_task(CallbackServer(dispatcher).run()))
+    elif conf.ingest_mode == 'longpoll':
+        tasks.append(asyncio.create_task(LongPoll(dispatcher, bot.session).run()))
+    else:
+        raise ValueError(f'Unknown ingest mode: {conf.ingest_mode}')
+    return tasks
@@ -1,13 +1,34 @@
 from loguru import logger
 from sqla_wrapper import SQLAlchemy
-from sqlalchemy import BigInteger, Column, ForeignKey, Integer, JSON, String, func
+from typing import NamedTuple, Optional
+
+from sqlalchemy import BigInteger, Boolean, Column, ForeignKey, Integer, JSON, String, bindparam, false, func
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import joinedload, relationship
 
 from forward import conf
 from .utils import db_session_scope
 
-db = SQLAlchemy(conf.db_uri, scopefunc=db_session_scope)
+db = SQLAlchemy(
+    conf.db_uri,
+    scopefunc=db_session_scope,
+    pool_size=conf.db_pool_size,
+    max_overflow=conf.db_max_overflow,
+    pool_timeout=conf.db_pool_timeout,
+    pool_recycle=conf.db_pool_recycle,
+    pool_pre_ping=conf.db_pool_pre_ping,
+)
+
+
+def pool_status():
+    pool = db.engine.pool
+    return {
+        'size': pool.size(),
+        'checked_in': pool.checkedin(),
+        'checked_out': pool.checkedout(),
+        'overflow': pool.overflow(),
+    }
 
 
 class BaseModel(db.Model):
@@ -26,6 +47,19 @@ class Admin(BaseModel):
     admin_id = Column(Integer, primary_key=True)
     chat_id = Column(BigInteger, unique=True)
 
+    @classmethod
+    def get_chat_ids(cls):
+        return [chat_id for chat_id, in db.query(cls.chat_id)]
+
+    @classmethod
+    def upsert(cls, chat_id):
+        """ Register chat in a single statement, returns False if it was already registered
+        """
+        stmt = insert(cls.__table__).values(chat_id=chat_id).on_conflict_do_nothing(index_elements=['chat_id'])
+        result = db.execute(stmt)
+        db.commit()
+        return result.rowcount == 1
+
 
 class Profile(BaseModel):
     profile_id = Column(Integer, primary_key=True)
@@ -47,11 +81,50 @@ class Profile(BaseModel):
     def create_from_item(cls, item):
         return cls.create(profile_id=item['id'], first_name=item['first_name'], last_name=item['last_name'], data=item)
 
+    @classmethod
+    def bulk_insert(cls, items):
+        rows = {
+            item['id']: dict(profile_id=item['id'], first_name=item['first_name'], last_name=item['last_name'], data=item)
+            for item in items
+        }
+        if rows:
+            db.execute(insert(cls.__table__).values(list(rows.values())).on_conflict_do_nothing())
+
+    @classmethod
+    def get_existing_ids(cls, profile_ids):
+        return [profile_id for profile_id, in db.query(cls.profile_id).filter(cls.profile_id.in_(profile_ids))]
+
     @property
     def profile_link(self):
         return f'https://vk.com/id{self.profile_id}'
 
 
+TEXT_CHANGED = 'text'
+COUNTERS_CHANGED = 'counters'
+
+
+def diff_item(text, likes, comments, item):
+    """ Returns TEXT_CHANGED or COUNTERS_CHANGED if VK item differs from the stored values, otherwise None
+    """
+    if text != item['text']:
+        return TEXT_CHANGED
+    if likes != item['likes']['count'] or comments != item['comments']['count']:
+        return COUNTERS_CHANGED
+
+
+class PostRecord(NamedTuple):
+    """ Column-only view of WallPost for the diff path, without identity map and JSON data
+    """
+    wall_post_id: int
+    text: Optional[str]
+    likes: Optional[int]
+    comments: Optional[int]
+    message_id: Optional[int]
+
+    def diff(self, item):
+        return diff_item(self.text, self.likes, self.comments, item)
+
+
 def max_size(sizes):
     sizes.sort(key=lambda k: k['height'])
     return sizes[-1]['url']
@@ -66,10 +139,12 @@ class WallPost(BaseModel):
     profile_id = Column(Integer, ForeignKey(Profile.profile_id), nullable=True)
     profile = relationship('Profile')
     message_id = Column(Integer)
+    # Imported history, it is sent only on request
+    backfilled = Column(Boolean, nullable=False, server_default=false())
 
-    @classmethod
-    def create_from_item(cls, item):
-        wall_post = cls(
+    @staticmethod
+    def row_from_item(item):
+        return dict(
             wall_post_id=item['id'],
             text=item['text'],
             comments=item['comments']['count'],
@@ -77,7 +152,19 @@ class WallPost(BaseModel):
             profile_id=item['from_id'],
             data=item
         )
-        return wall_post
+
+    @classmethod
+    def create_from_item(cls, item):
+        return cls(**cls.row_from_item(item))
+
+    @classmethod
+    def bulk_insert(cls, items, backfilled=False):
+        """ Insert posts skipping already existing ones, returns number of inserted rows
+        """
+        if not items:
+            return 0
+        rows = [dict(cls.row_from_item(item), backfilled=backfilled) for item in items]
+        return db.execute(insert(cls.__table__).values(rows).on_conflict_do_nothing()).rowcount
 
     @property
     def source(self):
@@ -106,24 +193,132 @@ class WallPost(BaseModel):
             to_update = to_update.options(joinedload(cls.profile))
         return to_update
 
+    @classmethod
+    def get_records(cls, items):
+        query = db.query(cls.wall_post_id, cls.text, cls.likes, cls.comments, cls.message_id).filter(
+            cls.wall_post_id.in_(items)
+        )
+        return [PostRecord(*row) for row in query]
+
+    @classmethod
+    def bulk_update(cls, items):
+        """ Write VK items over existing posts with a single executemany UPDATE
+        """
+        if not items:
+            return
+        table = cls.__table__
+        stmt = table.update().where(table.c.wall_post_id == bindparam('b_wall_post_id')).values(
+            text=bindparam('b_text', type_=table.c.text.type),
+            likes=bindparam('b_likes', type_=table.c.likes.type),
+            comments=bindparam('b_comments', type_=table.c.comments.type),
+            data=bindparam('b_data', type_=table.c.data.type),
+        )
+        db.execute(stmt, [
+            dict(
+                b_wall_post_id=item['id'],
+                b_text=item['text'],
+                b_likes=item['likes']['count'],
+                b_comments=item['comments']['count'],
+                b_data=item,
+            )
+            for item in items
+        ])
+
+    @classmethod
+    def get_existing_ids(cls, items):
+        return [wall_post_id for wall_post_id, in db.query(cls.wall_post_id).filter(cls.wall_post_id.in_(items))]
+
+    @classmethod
+    def get_unsent_ids(cls, after_id=0, until_id=None, limit=100, backfilled=None):
+        query = db.query(cls.wall_post_id).filter(cls.message_id.is_(None), cls.wall_post_id > after_id)
+        if until_id is not None:
+            query = query.filter(cls.wall_post_id <= until_id)
+        if backfilled is not None:
+            query = query.filter(cls.backfilled.is_(backfilled))
+        return [wall_post_id for wall_post_id, in query.order_by(cls.wall_post_id).limit(limit)]
+
     @classmethod
     def get_last_wall_post_id(cls):
         return db.query(func.max(cls.wall_post_id)).scalar()
 
+    @classmethod
+    def set_message_id(cls, wall_post_id, message_id):
+        db.query(cls).filter(cls.wall_post_id == wall_post_id).update({cls.message_id: message_id})
+
     def update_existing(self, item):
-        to_send = False
-        if self.text != item['text']:
+        """ Returns TEXT_CHANGED or COUNTERS_CHANGED if the post was modified, otherwise None
+        """
+        changed = diff_item(self.text, self.likes, self.comments, item)
+        if changed:
             self.text = item['text']
-            to_send = True
-        if self.comments != item['comments']['count']:
-            self.comments = item['comments']['count']
-            to_send = True
-        if self.likes != item['likes']['count']:
             self.likes = item['likes']['count']
-            to_send = True
-        if to_send:
+            self.comments = item['comments']['count']
             self.data = item
-        return to_send
+        return changed
 
     def __str__(self):
         return f'{self.wall_post_id} - {self.text}'
+
+
+def channel_ids():
+    """ Main channel and its mirrors, in order of delivery
+    """
+    return [conf.channel_id, *(conf.mirror_channel_ids or [])]
+
+
+class Delivery(BaseModel):
+    """ Message of the post in a mirror channel, the main channel message is WallPost.message_id
+    """
+    wall_post_id = Column(Integer, ForeignKey(WallPost.wall_post_id), primary_key=True)
+    chat_id = Column(BigInteger, primary_key=True)
+    message_id = Column(Integer)
+
+    @classmethod
+    def get_message_ids(cls, wall_post_id):
+        return dict(db.query(cls.chat_id, cls.message_id).filter(cls.wall_post_id == wall_post_id))
+
+    @classmethod
+    def get_chat_ids(cls, wall_post_ids):
+        """ wall_post_id -> mirror chat ids the post was delivered to
+        """
+        chat_ids = {}
+        query = db.query(cls.wall_post_id, cls.chat_id).filter(cls.wall_post_id.in_(wall_post_ids))
+        for wall_post_id, chat_id in query:
+            chat_ids.setdefault(wall_post_id, set()).add(chat_id)
+        return chat_ids
+
+    @classmethod
+    def save(cls, wall_post_id, message_ids):
+        if not message_ids:
+            return
+        stmt = insert(cls.__table__).values([
+            dict(wall_post_id=wall_post_id, chat_id=chat_id, message_id=message_id)
+            for chat_id, message_id in message_ids.items()
+        ])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['wall_post_id', 'chat_id'], set_={'message_id': stmt.excluded.message_id}
+        )
+        db.execute(stmt)
+
+
+class RenderState(BaseModel):
+    """ Digest of the content last rendered into telegram message
+    """
+    chat_id = Column(BigInteger, primary_key=True)
+    message_id = Column(Integer, primary_key=True)
+    digest = Column(String)
+
+    @classmethod
+    def get_digests(cls, chat_id, message_ids):
+        query = db.query(cls.message_id, cls.digest).filter(cls.chat_id == chat_id, cls.message_id.in_(message_ids))
+        return dict(query)
+
+    @classmethod
+    def save_digests(cls, chat_id, digests):
+        if not digests:
+            return
+        stmt = insert(cls.__table__).values(
+            [dict(chat_id=chat_id, message_id=message_id, digest=digest) for message_id, digest in digests.items()]
+        )
+        stmt = stmt.on_conflict_do_update(index_elements=['chat_id', 'message_id'], set_={'digest': stmt.excluded.digest})
+        db.execute(stmt)
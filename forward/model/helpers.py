@@ -3,14 +3,28 @@ import inspect
 import warnings
 import weakref
 from asyncio import get_event_loop
-from concurrent.futures import Executor
+from concurrent.futures import Executor, ThreadPoolExecutor
 from functools import partial, update_wrapper, wraps
 from threading import Event
 from typing import Callable, Optional
 
+from forward import conf
+from forward.profiling import incr
 from . import db
 
 
+def db_workers():
+    """ Pool capacity, None (executor default) when SQLAlchemy pool is unlimited: pool_size 0 or max_overflow -1
+    """
+    if conf.db_pool_size <= 0 or conf.db_max_overflow < 0:
+        return None
+    return conf.db_pool_size + conf.db_max_overflow
+
+
+# Bounded by the pool capacity, so a worker never waits on the pool for a connection
+db_executor = ThreadPoolExecutor(max_workers=db_workers(), thread_name_prefix='db')
+
+
 def wrapped_partial(func, *args, **kwargs):
     partial_func = partial(func, *args, **kwargs)
     update_wrapper(partial_func, func)
@@ -69,6 +83,7 @@ class ThreadSwitcher:
             coro = self._get_coro_object(id(previous_frame.f_code), id(previous_frame))
             if coro is None or coro.cr_frame is not previous_frame:
                 # Fallback to slow method with info from GC if there is no cache or if it's wrong
+                incr('gc_fallback')
                 warnings.warn(
                     "Going to use slow GC method to search coro object for {}. "
                     "Consider using '{}.optimized' decorator".format(
@@ -132,4 +147,4 @@ class ThreadSwitcherWithDB(ThreadSwitcher):
 
 
 def db_in_thread(executor=None):
-    return ThreadSwitcherWithDB(executor)
+    return ThreadSwitcherWithDB(executor or db_executor)
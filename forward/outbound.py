@@ -0,0 +1,173 @@
+import asyncio
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List
+
+import aiohttp
+from loguru import logger
+
+from forward.circuit import CircuitBreaker
+from forward.profiling import incr
+from forward.throttle import RateLimiter
+
+# Lower value is sent first
+NEW_POST = 0
+TEXT_EDIT = 1
+COUNTER_EDIT = 2
+PRIORITIES = (NEW_POST, TEXT_EDIT, COUNTER_EDIT)
+PRIORITY_NAMES = {NEW_POST: 'new_post', TEXT_EDIT: 'text_edit', COUNTER_EDIT: 'counter_edit'}
+# Seconds before retrying a failed job, doubled on each attempt
+RETRY_DELAY = 1
+MAX_RETRY_DELAY = 60
+
+
+class OutboundScheduler:
+    """ Single ordered queue of everything sent to the channel
+
+    Jobs are wall post ids, one queue per priority. Handlers render the latest post state when the job runs,
+    so a post is queued at most once: a job at higher priority covers the same post at lower ones.
+    Only counter edits are shed when their queue is full, new posts and text edits are never dropped.
+
+    Handlers return False when the job failed and raise on transport errors. Failed jobs, including ones
+    whose handler raised anything else, are retried from the head of their queue up to `max_attempts` times
+    with exponential backoff, which pauses the queue to keep order of delivery.
+    Transport errors feed the circuit breaker instead, which pauses the whole queue while telegram
+    is unreachable, so they are retried without limit.
+    """
+
+    def __init__(self, handlers: Dict[int, Callable[[int], Awaitable]], rate: float, capacity: int,
+                 high_watermark: int, circuit: CircuitBreaker, max_attempts: int):
+        self.handlers = handlers
+        self.circuit = circuit
+        self.max_attempts = max_attempts
+        self.attempts = {}
+        self.current = None
+        self.limiter = RateLimiter(rate)
+        self.capacity = capacity
+        self.high_watermark = high_watermark
+        self.queues = {priority: OrderedDict() for priority in PRIORITIES}
+        self.ready = asyncio.Event()
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    @property
+    def backpressure(self):
+        """ True when the poller should slow down and let the queue drain
+        """
+        return len(self) >= self.high_watermark
+
+    def queued_priority(self, wall_post_id):
+        for priority in PRIORITIES:
+            if wall_post_id in self.queues[priority]:
+                return priority
+
+    def submit(self, priority, wall_post_id):
+        queued = self.queued_priority(wall_post_id)
+        if queued is not None:
+            if queued <= priority:
+                return
+            del self.queues[queued][wall_post_id]
+        queue = self.queues[priority]
+        if len(queue) >= self.capacity and priority == COUNTER_EDIT:
+            stale, _ = queue.popitem(last=False)
+            logger.warning(f'Outbound queue is full, dropping counter edit of {stale}')
+            incr('shed_counter_edit')
+        queue[wall_post_id] = None
+        self.idle.clear()
+        self.ready.set()
+
+    def snapshot(self):
+        """ Queued and in-flight jobs as priority -> wall post ids
+        """
+        pending = {priority: list(queue) for priority, queue in self.queues.items()}
+        if self.current is not None:
+            priority, wall_post_id = self.current
+            pending[priority].insert(0, wall_post_id)
+        return pending
+
+    def restore(self, pending: Dict[int, List[int]]):
+        for priority in PRIORITIES:
+            for wall_post_id in pending.get(priority, []):
+                self.submit(priority, wall_post_id)
+
+    async def drain(self, timeout):
+        """ Wait until everything queued is sent, returns False on timeout
+        """
+        try:
+            await asyncio.wait_for(self.idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def retry(self, priority, wall_post_id):
+        """ Returns seconds to wait before the retry, 0 if the job is given up on
+        """
+        attempts = self.attempts.get(wall_post_id, 0) + 1
+        if attempts >= self.max_attempts:
+            # Unsent new posts are queued again on the next start
+            logger.error(f'Giving up outbound {PRIORITY_NAMES[priority]} of {wall_post_id} after {attempts} attempts')
+            incr('outbound_gave_up')
+            self.attempts.pop(wall_post_id, None)
+            return 0
+        self.attempts[wall_post_id] = attempts
+        incr('outbound_retry')
+        self.push_front(priority, wall_post_id)
+        return min(RETRY_DELAY * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+
+    def push_front(self, priority, wall_post_id):
+        queued = self.queued_priority(wall_post_id)
+        if queued is not None:
+            if queued <= priority:
+                # Resubmitted meanwhile, the fresh job covers this one
+                return
+            del self.queues[queued][wall_post_id]
+        # Keep order of delivery, returned job goes first
+        queue = self.queues[priority]
+        queue[wall_post_id] = None
+        queue.move_to_end(wall_post_id, last=False)
+
+    def pop(self):
+        for priority in PRIORITIES:
+            queue = self.queues[priority]
+            if queue:
+                wall_post_id, _ = queue.popitem(last=False)
+                return priority, wall_post_id
+
+    async def run(self):
+        while True:
+            job = self.pop()
+            if job is None:
+                self.ready.clear()
+                self.idle.set()
+                await self.ready.wait()
+                continue
+            priority, wall_post_id = job
+            if not self.circuit.allow():
+                self.push_front(priority, wall_post_id)
+                await asyncio.sleep(self.circuit.retry_in())
+                continue
+            self.current = job
+            delay = 0
+            try:
+                await self.limiter.acquire()
+                done = await self.handlers[priority](wall_post_id)
+            except asyncio.CancelledError:
+                raise
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                logger.exception(f'Transport error during outbound {PRIORITY_NAMES[priority]} of {wall_post_id}')
+                self.circuit.record_failure()
+                self.push_front(priority, wall_post_id)
+            except Exception:
+                logger.exception(f'Error during outbound {PRIORITY_NAMES[priority]} of {wall_post_id}')
+                delay = self.retry(priority, wall_post_id)
+            else:
+                self.circuit.record_success()
+                if done:
+                    self.attempts.pop(wall_post_id, None)
+                else:
+                    delay = self.retry(priority, wall_post_id)
+            self.current = None
+            if delay:
+                await asyncio.sleep(delay)
@@ -0,0 +1,94 @@
+import cProfile
+import datetime
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional
+
+from loguru import logger
+
+from forward import conf
+
+_lock = threading.Lock()
+# name -> [count, total seconds, max seconds]
+_spans = defaultdict(lambda: [0, 0.0, 0.0])
+_counters = defaultdict(int)
+_profiler: Optional[cProfile.Profile] = None
+
+
+@contextmanager
+def span(name):
+    """ Measure wall time of the block and account it under `name`
+
+    Safe to use from the event loop thread and from DB worker threads.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with _lock:
+            stat = _spans[name]
+            stat[0] += 1
+            stat[1] += elapsed
+            stat[2] = max(stat[2], elapsed)
+
+
+def incr(name, value=1):
+    with _lock:
+        _counters[name] += value
+
+
+def snapshot(reset=False):
+    with _lock:
+        spans = {
+            name: {'count': count, 'total_ms': round(total * 1000, 3), 'max_ms': round(max_ * 1000, 3)}
+            for name, (count, total, max_) in _spans.items()
+        }
+        counters = dict(_counters)
+        if reset:
+            _spans.clear()
+            _counters.clear()
+    return {'spans': spans, 'counters': counters}
+
+
+def report():
+    stats = snapshot(reset=True)
+    if not stats['spans'] and not stats['counters']:
+        return
+    stats['time'] = datetime.datetime.now().isoformat()
+    record = json.dumps(stats)
+    logger.info(f'Profiling: {record}')
+    if conf.profile_file:
+        with open(Path(conf.root_dir) / conf.profile_file, 'a') as f:
+            f.write(f'{record}\n')
+
+
+def profiler_running():
+    return _profiler is not None
+
+
+def start_profiler():
+    global _profiler
+    if _profiler is not None:
+        return
+    _profiler = cProfile.Profile()
+    _profiler.enable()
+    logger.info('Profiler started')
+
+
+def stop_profiler():
+    """ Stop the profiler and dump its stats, returns the dump path
+    """
+    global _profiler
+    if _profiler is None:
+        return
+    _profiler.disable()
+    path = Path(conf.root_dir) / f'profile-{datetime.datetime.now():%Y%m%d%H%M%S}.prof'
+    _profiler.dump_stats(str(path))
+    _profiler = None
+    logger.info(f'Profiler stopped, stats saved to {path}')
+    return path
@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Set
+
+from loguru import logger
+
+from forward import conf
+from forward.model import Delivery, Profile, WallPost, channel_ids
+from forward.outbound import NEW_POST
+
+# Fingerprints are only useful for posts still seen by the poll
+MAX_FINGERPRINTS = 1000
+
+
+def fingerprint(text, likes, comments):
+    return hashlib.sha1(json.dumps([text, likes, comments]).encode()).hexdigest()[:16]
+
+
+def item_fingerprint(item):
+    return fingerprint(item['text'], item['likes']['count'], item['comments']['count'])
+
+
+@dataclass
+class State:
+    """ In-memory service state, persisted between restarts
+
+    last_wall_post_id: poll cursor, same as max wall_post_id in DB
+    fingerprints: wall_post_id -> fingerprint of the last VK version applied to DB
+    profile_ids: profiles known to be in DB
+    pending: outbound priority -> queued wall post ids
+    """
+    last_wall_post_id: Optional[int] = None
+    fingerprints: Dict[int, str] = field(default_factory=dict)
+    profile_ids: Set[int] = field(default_factory=set)
+    pending: Dict[int, List[int]] = field(default_factory=dict)
+
+    def remember(self, items):
+        for item in items:
+            self.fingerprints[item['id']] = item_fingerprint(item)
+        if len(self.fingerprints) > MAX_FINGERPRINTS:
+            for wall_post_id in sorted(self.fingerprints)[:-MAX_FINGERPRINTS]:
+                del self.fingerprints[wall_post_id]
+
+    def is_unchanged(self, item):
+        return self.fingerprints.get(item['id']) == item_fingerprint(item)
+
+    def dump(self, path: Path):
+        data = asdict(self)
+        data['profile_ids'] = sorted(self.profile_ids)
+        tmp_path = path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: Path):
+        if not path.exists():
+            return cls()
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            return cls(
+                last_wall_post_id=data['last_wall_post_id'],
+                fingerprints={int(k): v for k, v in data['fingerprints'].items()},
+                profile_ids=set(data['profile_ids']),
+                pending={int(k): v for k, v in data['pending'].items()},
+            )
+        except (ValueError, KeyError, TypeError):
+            logger.exception(f'Broken state snapshot {path}, starting cold')
+            return cls()
+
+    def validate(self):
+        """ Drop everything which does not match DB, must be run in DB thread
+        """
+        last_wall_post_id = WallPost.get_last_wall_post_id()
+        if self.last_wall_post_id != last_wall_post_id:
+            logger.warning(f'Snapshot cursor {self.last_wall_post_id} does not match DB {last_wall_post_id}')
+            self.last_wall_post_id = last_wall_post_id
+        pending_ids = {wall_post_id for ids in self.pending.values() for wall_post_id in ids}
+        records = {
+            wall_post_id: (text, likes, comments, message_id)
+            for wall_post_id, text, likes, comments, message_id
+            in WallPost.get_records(list(set(self.fingerprints) | pending_ids))
+        }
+        self.fingerprints = {
+            wall_post_id: value for wall_post_id, value in self.fingerprints.items()
+            if wall_post_id in records and fingerprint(*records[wall_post_id][:3]) == value
+        }
+        delivered = Delivery.get_chat_ids(list(pending_ids))
+        for wall_post_id, (_, _, _, message_id) in records.items():
+            if message_id:
+                delivered.setdefault(wall_post_id, set()).add(conf.channel_id)
+        channels = set(channel_ids())
+
+        def is_pending(priority, wall_post_id):
+            chat_ids = delivered.get(wall_post_id, set())
+            # New posts must be still missing in some channel, edits need a sent message
+            if priority == NEW_POST:
+                return not channels <= chat_ids
+            return bool(chat_ids)
+
+        self.pending = {
+            priority: [
+                wall_post_id for wall_post_id in ids
+                if wall_post_id in records and is_pending(priority, wall_post_id)
+            ]
+            for priority, ids in self.pending.items()
+        }
+        self.profile_ids = set(Profile.get_existing_ids(list(self.profile_ids)))
+
+
+def state_path():
+    return Path(conf.root_dir) / conf.state_file
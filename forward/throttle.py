@@ -0,0 +1,25 @@
+import asyncio
+
+
+class RateLimiter:
+    """ Spreads acquisitions so that at most `rate` of them start per second
+    """
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self._next = 0.0
+
+    async def acquire(self):
+        loop = asyncio.get_event_loop()
+        now = loop.time()
+        start = max(now, self._next)
+        self._next = start + 1 / self.rate
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        pass
@@ -29,7 +29,10 @@ setup(
     url=URL,
     packages=find_packages('.'),
     entry_points={
-        'console_scripts': ['forward=forward.forward:run'],
+        'console_scripts': [
+            'forward=forward.forward:run',
+            'forward-backfill=forward.backfill:run',
+        ],
     },
     install_requires=REQUIRED,
     extras_require=EXTRAS,